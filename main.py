@@ -1,25 +1,54 @@
 import os
-import json
 import time
-from typing import Any, Dict
+import asyncio
+import urllib.request
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
+import orjson
 from dotenv import load_dotenv
 from pathlib import Path
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 import logging
 
+# Load environment variables
+load_dotenv()
+
 # Configure logging
-logging.basicConfig(level=logging.DEBUG, 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper(),
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Share one pooled HTTP/2 client so upstream connections are kept alive and
+    # multiplexed across requests. Proxy variables are applied by _upstream_mounts,
+    # so the client's own environment proxy mounts are turned off
+    app.state.http = httpx.AsyncClient(
+        mounts=_upstream_mounts(),
+        trust_env=False,
+        timeout=httpx.Timeout(connect=5, read=120, write=30, pool=5)
+    )
+    # Request logs are buffered and written in batches by a background task
+    global _log_queue, _models_cache_lock
+    _log_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    _models_cache_lock = asyncio.Lock()
+    log_writer_task = asyncio.create_task(log_writer())
+    yield
+    await _log_queue.put(None)
+    await log_writer_task
+    _close_log_file()
+    await app.state.http.aclose()
 
-app = FastAPI(title="OpenAI API Proxy with Request Tracking")
+app = FastAPI(
+    title="OpenAI API Proxy with Request Tracking",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
 
 # Add CORS middleware
 app.add_middleware(
@@ -38,6 +67,62 @@ if not OPENAI_API_KEY:
 OPENAI_BASE_URL = "https://api.openai.com/v1"
 GROQ_BASE_URL = "https://api.groq.com/openai/v1"
 LOGS_DIR = Path("logs")
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_BATCH_MS = int(os.getenv("LOG_BATCH_MS", "50"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_WRITE_BUFFER = 1 << 20
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(64 * 1024)))
+
+MODELS_CACHE_TTL = float(os.getenv("MODELS_CACHE_TTL", "60"))
+
+def _route(api_key: Optional[str], base_url: str):
+    """Build the (base URL, headers) pair used to forward requests to a backend."""
+    return base_url, {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+
+# Models served by a backend other than OpenAI
+MODEL_ROUTES = {
+    "qwen-2.5-coder-32b": _route(os.getenv("GROQ_API_KEY"), GROQ_BASE_URL),
+}
+DEFAULT_ROUTE = _route(OPENAI_API_KEY, OPENAI_BASE_URL)
+
+def _upstream_mounts():
+    """Mount a retrying HTTP/2 transport for each upstream host, honouring proxy environment variables."""
+    # httpx skips HTTP(S)_PROXY/ALL_PROXY/NO_PROXY for custom transports, so apply them here
+    proxies = urllib.request.getproxies_environment()
+    mounts = {}
+    for base_url in (OPENAI_BASE_URL, GROQ_BASE_URL):
+        url = httpx.URL(base_url)
+        proxy = None
+        if not urllib.request.proxy_bypass_environment(url.host):
+            proxy_url = proxies.get(url.scheme) or proxies.get("all")
+            proxy = httpx.Proxy(proxy_url) if proxy_url else None
+        mounts[f"{url.scheme}://{url.host}"] = httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=500, max_keepalive_connections=200, keepalive_expiry=60),
+            proxy=proxy
+        )
+    return mounts
+
+_log_queue: Optional[asyncio.Queue] = None
+
+# Logs go to one append-only file per day and process, kept open by the log writer
+_log_day: Optional[str] = None
+_log_file = None
+
+# Serialized /models response, refreshed from OpenAI at most once per MODELS_CACHE_TTL seconds
+_models_cache: Dict[str, Any] = {"bytes": None, "expires": 0.0}
+_models_cache_lock: Optional[asyncio.Lock] = None
+
+QWEN_MODEL = {
+    "id": "qwen-2.5-coder-32b",
+    "object": "model",
+    "created": 0,
+    "owned_by": "system"
+}
 
 # Ensure logs directory exists
 LOGS_DIR.mkdir(exist_ok=True)
@@ -45,10 +130,18 @@ LOGS_DIR.mkdir(exist_ok=True)
 # Log application start
 logger.info('Starting FastAPI application')
 
-async def save_request_response(request_data: Dict[str, Any], response_data: Dict[str, Any], endpoint: str):
-    logger.debug(f'Saving request and response for endpoint: {endpoint}')
-    timestamp = int(time.time() * 1000)  # Get current timestamp in milliseconds
-    filename = LOGS_DIR / f"{endpoint.replace('/', '_')}_{timestamp}.json"
+def _orjson_default(obj: Any) -> Any:
+    """Fallback for values orjson can't serialize natively."""
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode("utf-8", "replace")
+    return str(obj)
+
+def now_ms() -> int:
+    """Get current timestamp in milliseconds. Read once per request and passed along."""
+    return time.time_ns() // 1_000_000
+
+async def save_request_response(request_data: Dict[str, Any], response_data: Any, endpoint: str, timestamp: int):
+    logger.debug('Queueing request and response for endpoint: %s', endpoint)
     
     log_data = {
         "timestamp": timestamp,
@@ -57,15 +150,105 @@ async def save_request_response(request_data: Dict[str, Any], response_data: Dic
         "response": response_data
     }
     
-    with open(filename, 'w') as f:
-        json.dump(log_data, f, indent=2)
+    try:
+        _log_queue.put_nowait(log_data)
+    except asyncio.QueueFull:
+        logger.warning('Log queue is full, dropping log entry for endpoint: %s', endpoint)
+
+def _truncated_response(head: bytes, original_size: int) -> Dict[str, Any]:
+    """Log placeholder for a response larger than LOG_MAX_BYTES, keeping only its first bytes."""
+    return {
+        "truncated": True,
+        "original_size": original_size,
+        "head": head[:LOG_MAX_BYTES].decode("utf-8", "replace")
+    }
+
+def _decode_response(response_data: Any) -> Any:
+    """Parse raw upstream response bytes for logging, keeping the text if it isn't JSON."""
+    if not isinstance(response_data, bytes):
+        return response_data
+    if len(response_data) > LOG_MAX_BYTES:
+        return _truncated_response(response_data, len(response_data))
+    try:
+        return orjson.loads(response_data)
+    except orjson.JSONDecodeError:
+        return response_data.decode("utf-8", "replace")
+
+def _open_log_file():
+    """Return the append handle for today's log file, rotating to a new directory when the day changes."""
+    global _log_day, _log_file
+    day = time.strftime('%Y%m%d')
+    if day != _log_day:
+        if _log_file is not None:
+            _log_file.close()
+        day_dir = LOGS_DIR / day
+        day_dir.mkdir(exist_ok=True)
+        # Each worker process appends to its own file to avoid interleaved writes
+        _log_file = open(day_dir / f"events_{os.getpid()}.jsonl", 'ab', buffering=LOG_WRITE_BUFFER)
+        _log_day = day
+    return _log_file
+
+def _close_log_file():
+    global _log_day, _log_file
+    if _log_file is not None:
+        _log_file.close()
+    _log_day = None
+    _log_file = None
+
+def _flush_logs(batch: List[Dict[str, Any]]):
+    """Append a batch of log entries to today's JSONL file. Runs in a worker thread."""
+    lines = []
+    for log_data in batch:
+        # Skip entries that can't be serialized so they don't take the rest of the batch with them
+        try:
+            log_data["response"] = _decode_response(log_data["response"])
+            lines.append(orjson.dumps(
+                log_data,
+                default=_orjson_default,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE
+            ))
+        except Exception:
+            logger.exception('Skipping log entry for endpoint: %s', log_data.get("endpoint"))
     
-    return filename
+    _sync_write(_open_log_file(), lines)
 
-@app.options("/{path:path}")
-async def options_request(path: str):
-    logger.debug(f'Handling OPTIONS request for path: {path}')
-    """Handle OPTIONS requests and return available methods."""
+def _sync_write(f, lines: List[bytes]):
+    """Append lines through the file's 1 MiB buffer so a batch becomes a few large write() calls."""
+    f.writelines(lines)
+    f.flush()
+
+async def log_writer():
+    """Drain the log queue, flushing every LOG_BATCH_SIZE entries or LOG_BATCH_MS milliseconds."""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        log_data = await _log_queue.get()
+        if log_data is None:
+            break
+        
+        batch = [log_data]
+        deadline = loop.time() + LOG_BATCH_MS / 1000
+        while len(batch) < LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                log_data = await asyncio.wait_for(_log_queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+            if log_data is None:
+                stopping = True
+                break
+            batch.append(log_data)
+        
+        try:
+            await asyncio.to_thread(_flush_logs, batch)
+        except Exception:
+            # Keep the writer alive; a failed batch must not stop logging for the process
+            logger.exception('Error writing request logs')
+
+def _build_options_response(path: str):
+    """Build the OPTIONS body and headers for an endpoint."""
     # Define available methods based on the endpoint
     available_methods = ["OPTIONS"]
     endpoint_info = {}
@@ -90,118 +273,196 @@ async def options_request(path: str):
         "requires_auth": False
     }
     
-    return JSONResponse(
-        content={
-            "methods": available_methods,
-            "description": "OpenAI API Proxy with Request Tracking",
-            "endpoints": endpoint_info
-        },
-        headers={
-            "Allow": ", ".join(available_methods),
-            "Access-Control-Allow-Methods": ", ".join(available_methods),
-            "Access-Control-Allow-Headers": "*"
-        }
-    )
+    content = orjson.dumps({
+        "methods": available_methods,
+        "description": "OpenAI API Proxy with Request Tracking",
+        "endpoints": endpoint_info
+    })
+    headers = {
+        "Allow": ", ".join(available_methods),
+        "Access-Control-Allow-Methods": ", ".join(available_methods),
+        "Access-Control-Allow-Headers": "*"
+    }
+    return content, headers
+
+# OPTIONS responses are constant, so they are built once at import time
+_MODELS_OPTIONS = _build_options_response("models")
+_DEFAULT_OPTIONS = _build_options_response("")
+
+@app.options("/{path:path}")
+async def options_request(path: str):
+    logger.debug('Handling OPTIONS request for path: %s', path)
+    """Handle OPTIONS requests and return available methods."""
+    content, headers = _MODELS_OPTIONS if path == "models" else _DEFAULT_OPTIONS
+    return Response(content=content, media_type="application/json", headers=headers)
 
 @app.get("/models")
-async def get_models():
-    logger.info('Fetching available models from OpenAI API')
+async def get_models(request: Request):
     """Get available models from OpenAI API."""
+    timestamp = now_ms()
+    if time.monotonic() >= _models_cache["expires"]:
+        # Only one request refills the cache; the others wait and reuse its result
+        async with _models_cache_lock:
+            if time.monotonic() >= _models_cache["expires"]:
+                await _refresh_models(request.app.state.http, timestamp)
+    
+    # Save request and response
+    await save_request_response(
+        request_data={},
+        response_data=_models_cache["bytes"],
+        endpoint="models",
+        timestamp=timestamp
+    )
+    
+    return Response(content=_models_cache["bytes"], media_type="application/json")
+
+def _append_qwen_model(raw: bytes, timestamp: int) -> bytes:
+    """Splice the qwen-2.5-coder-32b model into the end of the raw OpenAI model list."""
+    QWEN_MODEL["created"] = timestamp // 1000
+    model = orjson.dumps(QWEN_MODEL)
+    
+    # The "data" array is the last one in the response, so its closing bracket is the last ']'
+    body = raw.strip()
+    data = body.find(b'"data"')
+    idx = body.rfind(b']')
+    if not (body.startswith(b'{') and body.endswith(b'}') and 0 < data < idx):
+        raise ValueError("unexpected model list format")
+    if body[:idx].rstrip()[-1:] != b'[':
+        model = b',' + model
+    return body[:idx] + model + body[idx:]
+
+async def _refresh_models(client: httpx.AsyncClient, timestamp: int):
+    """Fetch the model list from OpenAI and store the serialized result in the cache."""
+    logger.info('Fetching available models from OpenAI API')
     headers = {
         "Authorization": f"Bearer {OPENAI_API_KEY}",
     }
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                f"{OPENAI_BASE_URL}/models",
-                headers=headers
-            )
-            
-            # Get response data
-            response_data = response.json()
-            
-            # Add qwen-2.5-coder-32b model
-            response_data["data"].append({
-                "id": "qwen-2.5-coder-32b",
-                "object": "model", 
-                "created": int(time.time()),
-                "owned_by": "system"
-            })
-            
-            # Save request and response
-            await save_request_response(
-                request_data={},
-                response_data=response_data,
-                endpoint="models"
-            )
-            
-            return response_data
-            
-        except httpx.HTTPError as e:
-            logger.error(f'Error getting models: {str(e)}')
-            raise HTTPException(status_code=500, detail=f"Error getting models: {str(e)}")
+    try:
+        response = await client.get(
+            f"{OPENAI_BASE_URL}/models",
+            headers=headers
+        )
+        response.raise_for_status()
+        
+        _models_cache["bytes"] = _append_qwen_model(response.content, timestamp)
+        _models_cache["expires"] = time.monotonic() + MODELS_CACHE_TTL
+        
+    except (httpx.HTTPError, ValueError) as e:
+        logger.error('Error getting models: %s', e)
+        raise HTTPException(status_code=500, detail=f"Error getting models: {str(e)}")
 
 @app.post("/{path:path}")
 async def proxy_request(path: str, request: Request):
-    logger.info(f'Proxying request to path: {path}')
+    if logger.isEnabledFor(logging.INFO):
+        logger.info('Proxying request to path: %s', path)
     """Proxy endpoint that forwards requests to OpenAI API and logs the interaction."""
+    timestamp = now_ms()
     if path == "models":
         logger.warning('Method not allowed for /models endpoint with POST')
         raise HTTPException(status_code=405, detail="Method not allowed. Use GET for /models endpoint")
         
-    body = await request.json()
+    # The raw body is forwarded upstream unchanged; it is only parsed to route and log it
+    raw = await request.body()
+    try:
+        body = orjson.loads(raw) if raw else {}
+    except orjson.JSONDecodeError as e:
+        logger.warning('Invalid JSON body for path %s: %s', path, e)
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {str(e)}")
+    if not isinstance(body, dict):
+        logger.warning('JSON body for path %s is not an object', path)
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
     
-    # Determine API key and base URL based on model
+    # Determine base URL and headers based on model
     model = body.get("model")
-    if model == "qwen-2.5-coder-32b":
-        api_key = os.getenv("GROQ_API_KEY")
-        base_url = GROQ_BASE_URL
-    else:
-        api_key = OPENAI_API_KEY
-        base_url = OPENAI_BASE_URL
-
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
+    base_url, headers = MODEL_ROUTES.get(model, DEFAULT_ROUTE) if isinstance(model, str) else DEFAULT_ROUTE
+    
+    client = request.app.state.http
     
     if path == "chat/completions" and body.get("stream") is True:
+        try:
+            upstream_response = await client.send(
+                client.build_request("POST", f"{base_url}/{path}", content=raw, headers=headers),
+                stream=True
+            )
+        except httpx.HTTPError as e:
+            logger.error('Error forwarding request: %s', e)
+            raise HTTPException(status_code=500, detail=f"Error forwarding request: {str(e)}")
+        
+        # Pass chunks through untouched, keeping a bounded copy for the log entry
+        captured = bytearray()
+        size = 0
+        
         async def stream_response():
-            async with httpx.AsyncClient() as client:
-                async with client.stream("POST", f"{base_url}/{path}", json=body, headers=headers) as upstream_response:
-                    async for chunk in upstream_response.aiter_text():
-                        yield chunk
-        await save_request_response(
-            request_data=body,
-            response_data={"stream": True, "message": "streaming response"},
-            endpoint=path
+            nonlocal size
+            try:
+                async for chunk in upstream_response.aiter_bytes():
+                    size += len(chunk)
+                    if len(captured) < LOG_MAX_BYTES:
+                        captured.extend(chunk[:LOG_MAX_BYTES - len(captured)])
+                    yield chunk
+            finally:
+                # Also closed by finish_stream; this covers upstream errors that skip the background task
+                await upstream_response.aclose()
+        
+        async def finish_stream():
+            # Runs as a background task so it also happens when the client disconnects
+            # before or during the stream, outside the cancelled streaming scope
+            await upstream_response.aclose()
+            if size > LOG_MAX_BYTES:
+                response_data = _truncated_response(bytes(captured), size)
+            else:
+                response_data = bytes(captured)
+            await save_request_response(
+                request_data=body,
+                response_data=response_data,
+                endpoint=path,
+                timestamp=timestamp
+            )
+        
+        return StreamingResponse(
+            stream_response(),
+            status_code=upstream_response.status_code,
+            media_type=upstream_response.headers.get("content-type", "text/event-stream"),
+            background=BackgroundTask(finish_stream)
         )
-        return StreamingResponse(stream_response(), media_type="application/json")
     else:
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(
-                    f"{base_url}/{path}",
-                    json=body,
-                    headers=headers
-                )
-                
-                response_data = response.json()
-                
-                await save_request_response(
-                    request_data=body,
-                    response_data=response_data,
-                    endpoint=path
-                )
-                
-                return response_data
-                
-            except httpx.HTTPError as e:
-                logger.error(f'Error forwarding request: {str(e)}')
-                raise HTTPException(status_code=500, detail=f"Error forwarding request: {str(e)}")
+        try:
+            response = await client.post(
+                f"{base_url}/{path}",
+                content=raw,
+                headers=headers
+            )
+            
+            # Forward the upstream bytes as-is; they are only parsed when the log is written
+            await save_request_response(
+                request_data=body,
+                response_data=response.content,
+                endpoint=path,
+                timestamp=timestamp
+            )
+            
+            return Response(
+                content=response.content,
+                status_code=response.status_code,
+                media_type=response.headers.get("content-type", "application/json")
+            )
+            
+        except httpx.HTTPError as e:
+            logger.error('Error forwarding request: %s', e)
+            raise HTTPException(status_code=500, detail=f"Error forwarding request: {str(e)}")
 
 if __name__ == "__main__":
     logger.info('Running application with Uvicorn')
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # Workers need the app as an import string so each process can load it
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        # "auto" uses uvloop where it is installed (it is not available on Windows)
+        loop="auto",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 2)),
+        log_level="warning"
+    ) 
\ No newline at end of file